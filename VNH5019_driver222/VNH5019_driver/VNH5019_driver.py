@@ -8,6 +8,9 @@ import pigpio
 
 from PCA9685_wrapper import PWM
 
+# 前回とこの差以内のduty比は書き込まない
+_DUTY_DEADBAND = 1
+
 
 class VNH5019:
     def __init__(self, gpio_in1: int, gpio_in2: int, pwm_channel: int):
@@ -21,6 +24,10 @@ class VNH5019:
 
         # PWMドライバの初期化
         self.pwm = PWM(pwm_channel)
+        self._write_duty = self.pwm.setPWM
+
+        # 最後に書き込んだduty比
+        self._last_duty = None
 
         # pigpioの初期化
         self.pi = pigpio.pi()
@@ -29,11 +36,21 @@ class VNH5019:
         self.in1 = gpio_in1
         self.in2 = gpio_in2
 
+        # bank操作用のビットマスク
+        self._mask_in1 = 1 << self.in1
+        self._mask_in2 = 1 << self.in2
+
         # 制御ピンの初期化
         self.pi.set_mode(self.in1, pigpio.OUTPUT)
         self.pi.set_mode(self.in2, pigpio.OUTPUT)
-        self.pi.write(self.in1, 0)
-        self.pi.write(self.in2, 0)
+        self.pi.clear_bank_1(self._mask_in1 | self._mask_in2)
+
+        # 最後に設定したピンの状態(HIGHのピンのビットマスク)
+        self._pin_state = 0
+
+        # 駆動のたびに属性を辿らないようpigpioのメソッドを束縛しておく
+        self._set_bank_1 = self.pi.set_bank_1
+        self._clear_bank_1 = self.pi.clear_bank_1
 
         # loggerの設定
         self.init_logger(WARN)
@@ -74,16 +91,14 @@ class VNH5019:
     def free(self):
         """フリー状態にする
         """
-        self.pi.write(self.in1, 0)
-        self.pi.write(self.in2, 0)
-        self.pwm.setPWM(0)
+        self._set_pins(0)
+        self._set_duty(0)
 
     def brake(self):
         """ブレーキ状態にする
         """
-        self.pi.write(self.in1, 1)
-        self.pi.write(self.in2, 1)
-        self.pwm.setPWM(0)
+        self._set_pins(self._mask_in1 | self._mask_in2)
+        self._set_duty(0)
 
     def drive(self, pwm_duty_cycle: int):
         """モーターを駆動する変数
@@ -93,32 +108,76 @@ class VNH5019:
         """
         # 正の値であれば正転に設定
         if pwm_duty_cycle > 0:
-            self._forward(pwm_duty_cycle)
+            self._set_direction(self._mask_in1, pwm_duty_cycle)
 
-        # 負の値であれば逆転に設定
+        # 負の値であれば逆転に設定、符号はここで外す
         elif pwm_duty_cycle < 0:
-            self._back(pwm_duty_cycle)
+            self._set_direction(self._mask_in2, -pwm_duty_cycle)
 
         # 0ならフリー状態にする
         else:
             self.free()
 
-    def _forward(self, pwm_duty_cycle: int):
-        """正転用の関数
+    def drive_forward(self, pwm_duty_cycle: int):
+        """符号の判定をせずに正転で駆動する
 
         Args:
-            pwm_duty_cycle (int): duty_cycle
+            pwm_duty_cycle (int): duty比の絶対値
         """
-        self.pi.write(self.in1, 1)
-        self.pi.write(self.in2, 0)
-        self.pwm.setPWM(abs(pwm_duty_cycle))
+        self._set_direction(self._mask_in1, pwm_duty_cycle)
+
+    def drive_back(self, pwm_duty_cycle: int):
+        """符号の判定をせずに逆転で駆動する
+
+        Args:
+            pwm_duty_cycle (int): duty比の絶対値
+        """
+        self._set_direction(self._mask_in2, pwm_duty_cycle)
+
+    def _set_duty(self, pwm_duty_cycle: int):
+        """duty比を設定する、前回との差が_DUTY_DEADBAND以内なら書き込まない
+
+        0は停止に使うので差に関係なく書き込む
+
+        Args:
+            pwm_duty_cycle (int): 0~4095のduty比
+        """
+        last_duty = self._last_duty
+        if pwm_duty_cycle == last_duty:
+            return
+        if pwm_duty_cycle and last_duty is not None and \
+                abs(pwm_duty_cycle - last_duty) <= _DUTY_DEADBAND:
+            return
+
+        self._write_duty(pwm_duty_cycle)
+        self._last_duty = pwm_duty_cycle
+
+    def _set_pins(self, levels: int):
+        """IN1/IN2をbank操作でまとめて設定する、変化が無ければ何もしない
+
+        Args:
+            levels (int): HIGHにするピンのビットマスク
+        """
+        changed = levels ^ self._pin_state
+        if not changed:
+            return
+
+        on = changed & levels
+        off = changed & self._pin_state
+        self._pin_state = levels
+
+        # pigpiodはコマンドを届いた順に実行するので、bank操作なら後の書き込みに追い越されない
+        if on:
+            self._set_bank_1(on)
+        if off:
+            self._clear_bank_1(off)
 
-    def _back(self, pwm_duty_cycle: int):
-        """逆転用の関数
+    def _set_direction(self, pin_mask: int, pwm_duty_cycle: int):
+        """回転方向のピンとduty比を設定する
 
         Args:
-            pwm_duty_cycle (int): duty_cycle
+            pin_mask (int): HIGHにするピンのビットマスク、正転は_mask_in1、逆転は_mask_in2
+            pwm_duty_cycle (int): duty比の絶対値
         """
-        self.pi.write(self.in1, 0)
-        self.pi.write(self.in2, 1)
-        self.pwm.setPWM(abs(pwm_duty_cycle))
+        self._set_pins(pin_mask)
+        self._set_duty(pwm_duty_cycle)
@@ -2,13 +2,383 @@
 # -*- coding: utf-8 -*-
 
 import atexit
-from datetime import datetime, timedelta
+import ctypes
+from array import array
+from concurrent.futures import Future, wait as wait_futures
+from functools import partial, wraps
+import os
+import sys
+import threading
+import weakref
 from rotary_encoder import RotaryEncoder
-from logging import DEBUG, INFO, WARN, Formatter, StreamHandler, getLogger
+from logging import DEBUG, INFO, NOTSET, WARN, Formatter, StreamHandler, getLogger
+from logging.handlers import QueueHandler, QueueListener
+from math import copysign
+from queue import SimpleQueue
+from time import monotonic_ns, sleep
 
 import pigpio
 from PCA9685_wrapper import PWM
 
+# 待機の最後にスピンで待つ時間(ns)
+_SPIN_NS = 100_000
+
+# PWMの周波数(Hz)
+_PWM_FREQ = 16000
+
+# PCA9685のレジスタ
+_PCA9685_MODE1 = 0x00
+_PCA9685_MODE1_AI = 0x20
+_PCA9685_MODE1_RESTART = 0x80
+_PCA9685_LED0_ON_L = 0x06
+
+# 前回とこの差以内のduty比は書き込まない
+_DUTY_DEADBAND = 1
+
+# エッジ履歴のリングバッファの長さ(2のべき乗)
+_EDGE_BUF_LEN = 1024
+_EDGE_BUF_MASK = _EDGE_BUF_LEN - 1
+# 回転速度の推定に使うエッジ数の初期値
+_SPEED_WINDOW = 8
+
+# rotate_motorで目標付近に着いてから位置を合わせるduty比
+_SEEK_FINE_DUTY = 600
+
+# motor_speed_EXのデバッグ出力の間隔(ns)
+_PRINT_INTERVAL_NS = 100_000_000
+
+# 時間差で割るときの下限(s)
+_MIN_DT = 1e-6
+# 回転速度を計算し直すのに必要なエッジ間の時間(ns)
+_MIN_SPEED_DT_NS = 100_000
+
+# timerfd_createの引数(time.h, sys/timerfd.h)
+_CLOCK_MONOTONIC = 1
+_TFD_CLOEXEC = 0o2000000
+
+# mlockallのフラグ(sys/mman.h)
+_MCL_CURRENT = 1
+_MCL_FUTURE = 2
+
+# prctlでスリープの遅延許容幅(timer slack)を設定する番号と、制御スレッドに設定する値(ns)
+_PR_SET_TIMERSLACK = 29
+_CONTROL_TIMERSLACK_NS = 1
+
+# 停止を指示してから制御スレッドの終了を待つ秒数
+_STOP_JOIN_TIMEOUT = 1.0
+
+# shared_piで共有するpigpioのインスタンス、(host, port)ごとに1つ
+_PI_CACHE = weakref.WeakValueDictionary()
+
+# 全インスタンスで共有するログ出力用のリスナー
+_log_listener = None
+
+try:
+    from numba import njit
+except ImportError:
+    # numbaが無い環境では通常のPython関数として実行する
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+try:
+    from smbus2 import SMBus, i2c_msg
+except ImportError:
+    # smbus2が無ければPCA9685_wrapper経由で書き込む
+    SMBus = None
+
+try:
+    import _vnh5019_core
+except ImportError:
+    # ビルドされていなければPythonの制御ループを使う
+    _vnh5019_core = None
+
+
+@njit(cache=True, fastmath=True)
+def _compute_duty(speed: float) -> int:
+    """回転速度からduty比を計算する
+
+    Args:
+        speed (float): 回転速度(degree/s)
+
+    Returns:
+        int: -4095~4095に丸めたduty比
+    """
+    # floatのまま丸めてからintにする、先にintにすると無限大で例外になる
+    return int(max(-4095.0, min(4095.0, 5 * speed)))
+
+
+@njit(cache=True, fastmath=True)
+def _compute_pow(
+        diff: float,
+        KP: float,
+        min_speed: int,
+        max_speed: int) -> int:
+    """角度の偏差からP制御の出力を計算する
+
+    Args:
+        diff (float): 目標角度との偏差
+        KP (float): 比例ゲイン
+        min_speed (int): 最小速度
+        max_speed (int): 最大速度
+
+    Returns:
+        int: min_speed~max_speedに丸めた出力
+    """
+    raw = KP * diff
+
+    # 符号を保ったまま絶対値をmin_speed~max_speedに丸める
+    return int(copysign(min(max_speed, max(min_speed, abs(raw))), raw))
+
+
+@njit(cache=True, fastmath=True)
+def _pid_step(
+        speed: float,
+        current_speed: float,
+        error: float,
+        delta_time: float,
+        KP: float,
+        KI: float,
+        KD: float):
+    """速度のPID制御を1回分計算する
+
+    Args:
+        speed (float): 目標の回転速度(degree/s)
+        current_speed (float): 現在の回転速度(degree/s)
+        error (float): 前回までの偏差の積算値
+        delta_time (float): 前回からの経過時間(s)
+        KP (float): 比例ゲイン
+        KI (float): 積分ゲイン
+        KD (float): 微分ゲイン
+
+    Returns:
+        tuple: 出力する速度、今回の偏差、偏差の積算値
+    """
+    diff = speed - current_speed
+    error += diff
+
+    raw_gain = speed + KP * diff + KI * error * \
+        delta_time + KD * error / delta_time
+
+    return int(raw_gain), diff, error
+
+
+def _sleep_until(deadline_ns: int, stop: threading.Event = None) -> bool:
+    """指定時刻まで待機する、最後の_SPIN_NSだけスピンして精度を上げる
+
+    Args:
+        deadline_ns (int): monotonic_ns基準の目標時刻
+        stop (threading.Event, optional): セットされたら待機をやめる. Defaults to None.
+
+    Returns:
+        bool: stopで待機を打ち切ったかどうか
+    """
+    remaining = deadline_ns - monotonic_ns()
+    if remaining > _SPIN_NS:
+        if stop is None:
+            sleep((remaining - _SPIN_NS) * 1e-9)
+        elif stop.wait((remaining - _SPIN_NS) * 1e-9):
+            return True
+
+    while monotonic_ns() < deadline_ns:
+        pass
+
+    return False
+
+
+def _weak_callback(method):
+    """メソッドを弱参照で呼び出す関数を作る
+
+    Args:
+        method (method): 呼び出すメソッド
+
+    Returns:
+        callable: インスタンスが破棄されていれば何もしない関数
+    """
+    ref = weakref.WeakMethod(method)
+
+    def callback(way):
+        bound = ref()
+        if bound is not None:
+            bound(way)
+
+    return callback
+
+
+def _on_control_thread(method):
+    """メソッドをインスタンスの制御スレッドで実行させるデコレータ
+
+    呼び出し元は完了まで待ち、戻り値や例外もそのまま受け取る
+    キーワード引数wait=Falseを渡すと待たずにFutureを返す
+
+    Args:
+        method (function): 制御スレッドで実行するメソッド
+
+    Returns:
+        function: 制御スレッドにコマンドを積むメソッド
+    """
+    @wraps(method)
+    def wrapper(self, *args, wait=True, **kwargs):
+        # 制御スレッド内からの呼び出しはそのまま実行する
+        if threading.get_ident() == self._control_thread.ident:
+            return method(self, *args, **kwargs)
+
+        if not self._finalizer.alive:
+            raise RuntimeError("cleanup済みのモーターは駆動できない")
+
+        future = Future()
+        self._commands.put((future, method, (self, *args), kwargs))
+        if not wait:
+            return future
+
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            # Ctrl-Cで待ちを抜けたときは実行中の制御も止め、出力を切る
+            wait_futures([self._abort()], _STOP_JOIN_TIMEOUT)
+            if self._finalizer.alive:
+                self._stop.clear()
+            self._free()
+            raise
+
+    return wrapper
+
+
+def _control_loop(commands, stop):
+    """制御スレッドの本体、キューに積まれたコマンドを順に実行する
+
+    Args:
+        commands (SimpleQueue): (Future, 関数, 位置引数, キーワード引数)のキュー、Noneで終了
+        stop (threading.Event): セットされている間に取り出したコマンドは実行しない
+    """
+    # 周期待ちのスリープが遅れないようにtimer slackを最小にする
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.prctl(_PR_SET_TIMERSLACK, ctypes.c_ulong(_CONTROL_TIMERSLACK_NS))
+    except (OSError, AttributeError):
+        pass
+
+    while True:
+        command = commands.get()
+        if command is None:
+            return
+
+        future, func, args, kwargs = command
+        # funcがNoneのコマンドは、それより前のコマンドが終わったことを知らせる目印
+        if stop.is_set() or func is None:
+            future.cancel()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        # 結果を返した後までインスタンスを掴み続けないようにする
+        del command, future, func, args, kwargs
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """書式化もQueueListener側のスレッドで行うQueueHandler"""
+
+    def prepare(self, record):
+        return record
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class _Itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _Timespec), ("it_value", _Timespec)]
+
+
+def _open_timerfd(period_ns: int):
+    """一定周期で満了するtimerfdを作る
+
+    Args:
+        period_ns (int): 周期(ns)
+
+    Returns:
+        int: ファイルディスクリプタ、使えない環境ではNone
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        timerfd_create = libc.timerfd_create
+        timerfd_settime = libc.timerfd_settime
+    except (OSError, TypeError, AttributeError):
+        return None
+
+    fd = timerfd_create(_CLOCK_MONOTONIC, _TFD_CLOEXEC)
+    if fd < 0:
+        return None
+
+    # 初回はすぐに満了させ、以降は周期ごとに満了させる
+    spec = _Itimerspec(
+        _Timespec(period_ns // 1_000_000_000, period_ns % 1_000_000_000),
+        _Timespec(0, 1))
+    if timerfd_settime(fd, 0, ctypes.byref(spec), None) != 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _sleep_ticks(period_ns: int, stop: threading.Event = None):
+    """timerfdが使えない環境向けの_ticks、sleepとスピンで周期を作る
+
+    Args:
+        period_ns (int): 周期(ns)
+        stop (threading.Event, optional): セットされたら終了する. Defaults to None.
+
+    Yields:
+        tuple: 各周期の開始時刻(ns)と前回から経過した周期数
+    """
+    next_tick_ns = monotonic_ns()
+    expirations = 1
+    while True:
+        if _sleep_until(next_tick_ns, stop):
+            return
+        yield monotonic_ns(), expirations
+
+        next_tick_ns += period_ns
+        expirations = 1
+        behind_ns = monotonic_ns() - next_tick_ns
+        if behind_ns > period_ns:
+            skipped = behind_ns // period_ns
+            next_tick_ns += skipped * period_ns
+            expirations += skipped
+
+
+def _ticks(period_ns: int, stop: threading.Event = None):
+    """一定周期で現在時刻を返すジェネレータ
+
+    timerfdの満了を待つので待機中はCPUを使わない
+    1周期以上遅れた場合は遅れた分の周期を読み飛ばし、経過した周期数で知らせる
+
+    Args:
+        period_ns (int): 周期(ns)
+        stop (threading.Event, optional): セットされたら終了する. Defaults to None.
+
+    Yields:
+        tuple: 各周期の開始時刻(ns)と前回から経過した周期数
+    """
+    fd = _open_timerfd(period_ns)
+    if fd is None:
+        yield from _sleep_ticks(period_ns, stop)
+        return
+
+    try:
+        while True:
+            expirations = int.from_bytes(os.read(fd, 8), sys.byteorder)
+            if stop is not None and stop.is_set():
+                return
+            yield monotonic_ns(), expirations
+    finally:
+        os.close(fd)
+
 
 class VNH5019:
     def __init__(
@@ -20,7 +390,13 @@ class VNH5019:
             encoder_in2: int,
             pwm_channel: int,
             gear_ratio: float,
-            logging_level: int = INFO):
+            logging_level: int = INFO,
+            control_hz: int = 1000,
+            pwm_gpio: int = None,
+            speed_window: int = _SPEED_WINDOW,
+            encoder_glitch_us: int = 0,
+            i2c_bus: int = 1,
+            i2c_address: int = 0x40):
         """VNH5019のインスタンスを初期化
 
         Args:
@@ -29,49 +405,200 @@ class VNH5019:
             driver_out2 (int): モータードライバのIN2
             pwm_channel (int): PCA9685のチャンネル
             logging_level (int): ロガーのレベル
+            control_hz (int): 制御ループの周波数(Hz)
+            pwm_gpio (int): ハードウェアPWMを使う場合のgpioピン
+            speed_window (int): 回転速度の推定に使うエッジ数
+            encoder_glitch_us (int): pigpiod側でチャタリングを除去する時間(µs)、0なら無効
+            i2c_bus (int): PCA9685がつながっているI2Cバス
+            i2c_address (int): PCA9685のI2Cアドレス
         """
 
-        # PWMドライバの初期化
-        self.pwm = PWM(pwm_channel, freq=16000)
+        if not 0 < speed_window < _EDGE_BUF_LEN:
+            raise ValueError(
+                f"speed_window must be between 1 and {_EDGE_BUF_LEN - 1}")
 
         # pigpioの初期化
         self.pi = pi
 
+        # PWMドライバの初期化
+        # 終了処理でselfを参照せずに出力を止められるよう、duty比0の書き込みも用意しておく
+        self._bus = None
+        if pwm_gpio is None:
+            self.pwm = PWM(pwm_channel, freq=_PWM_FREQ)
+            if SMBus is None:
+                self._write_duty = self.pwm.setPWM
+                stop_pwm = partial(self.pwm.setPWM, 0)
+            else:
+                self._open_i2c(pwm_channel, i2c_bus, i2c_address)
+                self._write_duty = self._fast_setPWM
+                stop_pwm = partial(self._i2c_rdwr, i2c_msg.write(
+                    i2c_address, [self._led_reg, 0, 0, 0, 0]))
+        else:
+            self.pwm = None
+            self._pwm_gpio = pwm_gpio
+            self._write_duty = self._write_hw_duty
+            stop_pwm = partial(pi.hardware_PWM, pwm_gpio, _PWM_FREQ, 0)
+
+        # 最後に書き込んだduty比
+        self._last_duty = None
+
         # pin設定をクラス内変数化
         self.in1 = driver_out1
         self.in2 = driver_out2
 
+        # bank操作用のビットマスク
+        self._mask_in1 = 1 << self.in1
+        self._mask_in2 = 1 << self.in2
+
         # 制御ピンの初期化
         self.pi.set_mode(self.in1, pigpio.OUTPUT)
         self.pi.set_mode(self.in2, pigpio.OUTPUT)
-        self.pi.write(self.in1, 0)
-        self.pi.write(self.in2, 0)
+        self.pi.clear_bank_1(self._mask_in1 | self._mask_in2)
+
+        # 最後に設定したピンの状態(HIGHのピンのビットマスク)
+        self._pin_state = 0
+
+        # 駆動のたびに属性を辿らないようpigpioのメソッドを束縛しておく
+        self._set_bank_1 = self.pi.set_bank_1
+        self._clear_bank_1 = self.pi.clear_bank_1
 
         # loggerの設定
         self.init_logger(logging_level)
 
         # ロータリーエンコーダ用変数
-        self.count = 0.0
-        self.prev_current_time = datetime.now()
-        self.one_count = 360 * 4 / (64 * gear_ratio)
-        self.rotation_speed = 0.0
-        self.print_counter = 0
-        self.angle = 0.0
-        self.prev_angle = 0.0
+        self.count = 0
+        # エンコーダは4逓倍で読むので1カウントは1/64回転
+        self.one_count = 360 / (64 * gear_ratio)
+        # カウント/nsからdegree/sへの換算係数
+        self._speed_scale = self.one_count * 1e9
+        self._next_print_ns = 0
+
+        # エッジごとの時刻とカウントの履歴
+        self._edge_ns = array('q', [monotonic_ns()]) * _EDGE_BUF_LEN
+        self._edge_count = array('q', [0]) * _EDGE_BUF_LEN
+        self._edge_idx = 0
+        self._speed_window = speed_window
+        self._rotation_speed = 0.0
+
+        # 制御ループの周期
+        self.period_ns = 1_000_000_000 // control_hz
 
         # PID制御用変数
         self.diff = 0.0
         self.error = 0.0
-        self.prev_time = datetime.now()
+        self.prev_time_ns = monotonic_ns()
+
+        # rotate_motor用変数、目標カウントがNoneでなければコールバックで駆動を切り替える
+        self._target_count = None
+        self._seek_duty = 0
+        # 駆動中の向き、1なら正転、-1なら逆転、0なら停止中
+        self._seek_dir = 0
+        self._angle_event = threading.Event()
+        self._seek_lock = threading.Lock()
 
         # 終了処理フラグ
         self.in_exit = False
 
+        # 制御ループの初回でJITコンパイルが走らないよう事前に呼んでおく
+        _compute_duty(0.0)
+        _compute_pow(0.0, 1.0, 0, 0)
+        _pid_step(0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0)
+
         # ロータリーエンコーダの初期化
-        RotaryEncoder(pi, encoder_in1, encoder_in2, self.callback)
+        # コールバックは弱参照で渡し、エンコーダがインスタンスを生かし続けないようにする
+        encoder = RotaryEncoder(
+            pi,
+            encoder_in1,
+            encoder_in2,
+            _weak_callback(self.callback),
+            glitch_us=encoder_glitch_us)
+
+        # 制御ループはエンコーダのコールバックとは別の専用スレッドで回す
+        # スレッドにはselfを渡さず、コマンドのキューだけを持たせる
+        self._commands = SimpleQueue()
+        # 実行中の制御ループに停止を知らせるイベント
+        self._stop = threading.Event()
+        self._control_thread = threading.Thread(
+            target=_control_loop,
+            args=(self._commands, self._stop),
+            name="VNH5019-control",
+            daemon=True)
+        self._control_thread.start()
+
+        # インスタンスの破棄時かプログラム終了時に全出力を切る
+        # selfを参照すると回収されなくなるため、必要なハンドルだけを渡す
+        self._finalizer = weakref.finalize(
+            self,
+            VNH5019._static_cleanup,
+            pi,
+            self._mask_in1 | self._mask_in2,
+            stop_pwm,
+            self._bus,
+            encoder,
+            self._commands,
+            self._stop,
+            self._angle_event,
+            self._control_thread)
+
+    @classmethod
+    def using_hw_pwm(
+            cls,
+            pi: pigpio.pi,
+            driver_out1: int,
+            driver_out2: int,
+            encoder_in1: int,
+            encoder_in2: int,
+            pwm_gpio: int,
+            gear_ratio: float,
+            **kwargs):
+        """PCA9685を使わずにpigpioのハードウェアPWMで駆動するインスタンスを作る
+
+        I2Cを経由しないのでduty比の更新が速い、使えるのはgpio12,13,18,19のみ
+
+        Args:
+            pi (pigpio.pi): pigpioインスタンス
+            driver_out1 (int): モータードライバのIN1
+            driver_out2 (int): モータードライバのIN2
+            pwm_gpio (int): モータードライバのPWMにつなぐgpioピン
 
-        # 終了時に全出力を切る
-        atexit.register(self.cleanup)
+        Returns:
+            VNH5019: 作成したインスタンス
+        """
+        return cls(
+            pi,
+            driver_out1=driver_out1,
+            driver_out2=driver_out2,
+            encoder_in1=encoder_in1,
+            encoder_in2=encoder_in2,
+            pwm_channel=None,
+            gear_ratio=gear_ratio,
+            pwm_gpio=pwm_gpio,
+            **kwargs)
+
+    @classmethod
+    def shared_pi(cls, host: str = None, port: int = None):
+        """接続先ごとに共有するpigpioのインスタンスを返す
+
+        複数のモーターで同じインスタンスを使えば、pigpiodとの通信を1本にまとめられる
+
+        Args:
+            host (str, optional): pigpiodのホスト. Defaults to None(pigpioの既定値).
+            port (int, optional): pigpiodのポート. Defaults to None(pigpioの既定値).
+
+        Returns:
+            pigpio.pi: pigpioのインスタンス
+        """
+        key = (host, port)
+        pi = _PI_CACHE.get(key)
+        if pi is None or not pi.connected:
+            kwargs = {}
+            if host is not None:
+                kwargs["host"] = host
+            if port is not None:
+                kwargs["port"] = port
+            pi = pigpio.pi(**kwargs)
+            _PI_CACHE[key] = pi
+        return pi
 
     def init_logger(self, level):
         """ロガーの初期化
@@ -84,8 +611,16 @@ class VNH5019:
         self.logger = getLogger(__name__)
         # ログが複数回表示されるのを防止
         self.logger.propagate = False
-        # ロガー自体のロギングレベル
-        self.logger.setLevel(level)
+        # ロガーは全インスタンスで共有するので、いちばん細かいレベルに合わせる
+        if self.logger.level == NOTSET or level < self.logger.level:
+            self.logger.setLevel(level)
+        # 出力するかはインスタンスごとのレベルで判定し、制御ループ内で毎回判定しないようにキャッシュする
+        self._debug = level <= DEBUG
+
+        # ハンドラは全インスタンスで共有し、ログが二重に出力されないよう一度だけ追加する
+        global _log_listener
+        if _log_listener is not None:
+            return
 
         # ログを標準出力へ
         handler = StreamHandler()
@@ -94,51 +629,221 @@ class VNH5019:
             Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
         # このハンドラのロギングレベル
         handler.setLevel(DEBUG)
+
+        # 書式化と出力は別スレッドに任せ、制御ループではキューに積むだけにする
+        log_queue = SimpleQueue()
+        _log_listener = QueueListener(log_queue, handler)
+        _log_listener.start()
+        # 終了時に残ったログを出し切る
+        atexit.register(_log_listener.stop)
         # ロガーにハンドラを追加
-        self.logger.addHandler(handler)
+        self.logger.addHandler(_DeferredQueueHandler(log_queue))
 
     def callback(self, way):
-        current_time = datetime.now()
+        if not way:
+            return
 
         self.count += way
 
-        self.angle = self.count * self.one_count
+        # 速度の計算はget_rotation_speedに任せ、ここでは履歴に積むだけにする
+        idx = (self._edge_idx + 1) & _EDGE_BUF_MASK
+        self._edge_ns[idx] = monotonic_ns()
+        self._edge_count[idx] = self.count
+        self._edge_idx = idx
 
-        elapsed_angle = self.angle - self.prev_angle
-        elapsed_time = (current_time - self.prev_current_time) / \
-            timedelta(seconds=1)
-        self.rotation_speed = elapsed_angle / elapsed_time
-        # print(f"elapsed_time={elapsed_time:.3f}")
+        # self.logger.debug("count=%d", self.count)
 
-        # self.logger.debug(f"angle={self.angle:.0f}")
-        # self.logger.debug(f"rotation_speed={self.rotation_speed:.0f}")
+        if self._target_count is not None:
+            self._seek()
 
-        self.prev_current_time = current_time
-        self.prev_angle = self.angle
+    def _seek(self):
+        """目標角度に向けて駆動を切り替える、目標に着くか通り過ぎたらフリーにして知らせる
+
+        エッジはまとめて届くことがあり、カウントが目標を飛び越えるので一致では判定しない
+        """
+        with self._seek_lock:
+            target_count = self._target_count
+            if target_count is None:
+                return
+
+            diff = target_count - self.count
+            if not diff or diff * self._seek_dir < 0:
+                self._free()
+                self._seek_dir = 0
+                # 行き過ぎた分を戻すときから弱いduty比で合わせる
+                self._seek_duty = _SEEK_FINE_DUTY
+                self._angle_event.set()
+            elif diff > 0:
+                self.drive_forward(self._seek_duty)
+                self._seek_dir = 1
+            else:
+                self.drive_back(self._seek_duty)
+                self._seek_dir = -1
+
+    @_on_control_thread
+    def enable_realtime(self, cpu: int = 2, prio: int = 80):
+        """制御スレッドをリアルタイム優先度で特定のCPUに固定する
+
+        エンコーダのコールバックのスレッドは固定しないので、他のCPUで動き続ける
+
+        効果を出すにはカーネルの起動パラメータに
+        isolcpus=2 nohz_full=2 rcu_nocbs=2 のように対象CPUを指定して
+        他のタスクから隔離しておくこと。root権限が必要
+
+        Args:
+            cpu (int, optional): 固定するCPU番号. Defaults to 2.
+            prio (int, optional): SCHED_FIFOの優先度. Defaults to 80.
+        """
+        os.sched_setaffinity(0, {cpu})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(prio))
+
+        # ページフォルトによる揺らぎを防ぐためメモリを固定する
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.mlockall(_MCL_CURRENT | _MCL_FUTURE) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
 
     def cleanup(self):
         """インスタンス破棄時に実行、出力を止める
         """
-        if not self.in_exit:
+        if self.in_exit:
             return
-        self.free()
-        self.pi.stop()
         self.in_exit = True
+        self._finalizer()
+
+        # 出力は切ったので、次の書き込みを省略しないよう記録も戻す
+        self._pin_state = 0
+        self._last_duty = 0
 
+    @staticmethod
+    def _static_cleanup(
+            pi, pin_mask, stop_pwm, bus, encoder, commands,
+            stop, angle_event, control_thread):
+        """出力を止めて資源を解放する
+
+        weakref.finalizeから呼ばれるため、インスタンスは受け取らない
+        piは呼び出し元と共有しているので止めない
+
+        Args:
+            pi (pigpio.pi): pigpioのインスタンス
+            pin_mask (int): モータードライバの出力ピンのビットマスク
+            stop_pwm (callable): duty比を0にする関数
+            bus (SMBus): PCA9685に直接書き込むためのI2Cバス
+            encoder (RotaryEncoder): ロータリーエンコーダ
+            commands (SimpleQueue): 制御スレッドのコマンドキュー
+            stop (threading.Event): 制御ループの停止イベント
+            angle_event (threading.Event): rotate_motorが待っているイベント
+            control_thread (threading.Thread): 制御スレッド
+        """
+        # 実行中の制御を止め、制御スレッドが出力に触らなくなってから出力を切る
+        stop.set()
+        angle_event.set()
+        commands.put(None)
+        encoder.cancel()
+        if control_thread is not threading.current_thread():
+            control_thread.join(_STOP_JOIN_TIMEOUT)
+        pi.clear_bank_1(pin_mask)
+        stop_pwm()
+        if bus is not None:
+            bus.close()
 
     def free(self):
         """フリー状態にする
+
+        実行中の制御も止める、free_all(self)と同じ
         """
-        self.pi.write(self.in1, 0)
-        self.pi.write(self.in2, 0)
-        self.pwm.setPWM(0)
+        self._set_pins_all((self,), 0)
 
     def brake(self):
         """ブレーキ状態にする
+
+        実行中の制御も止める、brake_all(self)と同じ
+        """
+        self._set_pins_all((self,), 1)
+
+    def _free(self):
+        """制御を止めずにフリー状態にする、制御ループやコールバックから使う
+        """
+        self._set_pins(0)
+        self._set_duty(0)
+
+    def _brake(self):
+        """制御を止めずにブレーキ状態にする、制御ループやコールバックから使う
+        """
+        self._set_pins(self._mask_in1 | self._mask_in2)
+        self._set_duty(0)
+
+    def _abort(self) -> Future:
+        """実行中の制御を止め、待っているコマンドも取り消す
+
+        Returns:
+            Future: 制御スレッドが出力に触らなくなったら完了する
+        """
+        self._stop.set()
+        with self._seek_lock:
+            self._target_count = None
+        self._angle_event.set()
+
+        idle = Future()
+        if not self._finalizer.alive or \
+                threading.get_ident() == self._control_thread.ident:
+            idle.cancel()
+        else:
+            self._commands.put((idle, None, (), {}))
+        return idle
+
+    @classmethod
+    def free_all(cls, *motors):
+        """複数のモーターをまとめてフリー状態にする
+
+        実行中の制御は止め、出力ピンはpigpioのインスタンスごとに1回のbank操作で切り替える
+
+        Args:
+            motors (VNH5019): 対象のモーター
+        """
+        cls._set_pins_all(motors, 0)
+
+    @classmethod
+    def brake_all(cls, *motors):
+        """複数のモーターをまとめてブレーキ状態にする
+
+        実行中の制御は止め、出力ピンはpigpioのインスタンスごとに1回のbank操作で切り替える
+
+        Args:
+            motors (VNH5019): 対象のモーター
         """
-        self.pi.write(self.in1, 1)
-        self.pi.write(self.in2, 1)
-        self.pwm.setPWM(0)
+        cls._set_pins_all(motors, 1)
+
+    @staticmethod
+    def _set_pins_all(motors, level: int):
+        """複数のモーターのIN1/IN2を同じレベルにしてduty比を0にする
+
+        Args:
+            motors (list): 対象のモーター
+            level (int): 0ならLOW、1ならHIGH
+        """
+        # 制御スレッドやrotate_motorのコールバックが後から出力を戻さないよう、先に止めておく
+        idle = [motor._abort() for motor in motors]
+        wait_futures(idle, _STOP_JOIN_TIMEOUT)
+        for motor in motors:
+            if motor._finalizer.alive:
+                motor._stop.clear()
+
+        masks = {}
+        for motor in motors:
+            mask = motor._mask_in1 | motor._mask_in2
+            pi, total = masks.get(id(motor.pi), (motor.pi, 0))
+            masks[id(motor.pi)] = (pi, total | mask)
+            motor._pin_state = mask if level else 0
+
+        for pi, mask in masks.values():
+            if level:
+                pi.set_bank_1(mask)
+            else:
+                pi.clear_bank_1(mask)
+
+        for motor in motors:
+            motor._set_duty(0)
 
     def drive(self, pwm_duty_cycle: int):
         """モーターを駆動する変数
@@ -148,16 +853,33 @@ class VNH5019:
         """
         # 正の値であれば正転に設定
         if pwm_duty_cycle > 0:
-            self._forward(pwm_duty_cycle)
+            self._set_direction(self._mask_in1, pwm_duty_cycle)
 
-        # 負の値であれば逆転に設定
+        # 負の値であれば逆転に設定、符号はここで外す
         elif pwm_duty_cycle < 0:
-            self._back(pwm_duty_cycle)
+            self._set_direction(self._mask_in2, -pwm_duty_cycle)
 
         # 0ならフリー状態にする
         else:
-            self.free()
+            self._free()
+
+    def drive_forward(self, pwm_duty_cycle: int):
+        """符号の判定をせずに正転で駆動する
+
+        Args:
+            pwm_duty_cycle (int): duty比の絶対値
+        """
+        self._set_direction(self._mask_in1, pwm_duty_cycle)
+
+    def drive_back(self, pwm_duty_cycle: int):
+        """符号の判定をせずに逆転で駆動する
+
+        Args:
+            pwm_duty_cycle (int): duty比の絶対値
+        """
+        self._set_direction(self._mask_in2, pwm_duty_cycle)
 
+    @_on_control_thread
     def drive_until(self, pwm_duty_cycle: int, drive_time: float):
         """一定の秒数モーターを駆動する変数
 
@@ -166,36 +888,114 @@ class VNH5019:
             drive_time (float): 駆動秒数(単位は秒)
         """
 
-        drive_time = drive_time * 1000 * 1000
+        end_ns = monotonic_ns() + int(drive_time * 1e9)
 
-        start_time = datetime.now()
-        while True:
-            driven_time = (datetime.now() - start_time) / \
-                timedelta(microseconds=1)
-            self.drive(pwm_duty_cycle)
+        # 出力は変わらないので一度設定したら終了時刻まで待つだけでよい
+        self.drive(pwm_duty_cycle)
+        if _sleep_until(end_ns, self._stop):
+            return
+        self._free()
 
-            if driven_time > drive_time:
-                break
+    def _write_hw_duty(self, pwm_duty_cycle: int):
+        """ハードウェアPWMのduty比を設定する
+
+        Args:
+            pwm_duty_cycle (int): 0~4095のduty比、範囲外は丸める
+        """
+        # PCA9685側と同じく範囲外は飽和させる
+        pwm_duty_cycle = max(0, min(4095, int(pwm_duty_cycle)))
+        # pigpioのハードウェアPWMは0~1000000で指定する
+        self.pi.hardware_PWM(
+            self._pwm_gpio, _PWM_FREQ, pwm_duty_cycle * 1_000_000 // 4095)
+
+    def _open_i2c(self, pwm_channel: int, i2c_bus: int, i2c_address: int):
+        """PCA9685のduty比を直接書き込むためにI2Cバスを開く
+
+        周波数などの設定はPCA9685_wrapperに任せ、ここではレジスタの自動インクリメントだけ有効にする
+
+        Args:
+            pwm_channel (int): PCA9685のチャンネル
+            i2c_bus (int): I2Cバス
+            i2c_address (int): PCA9685のI2Cアドレス
+        """
+        self._bus = SMBus(i2c_bus)
+        self._i2c_address = i2c_address
+        self._led_reg = _PCA9685_LED0_ON_L + 4 * pwm_channel
+        self._i2c_rdwr = self._bus.i2c_rdwr
 
-    def _forward(self, pwm_duty_cycle: int):
-        """正転用の関数
+        mode1 = self._bus.read_byte_data(i2c_address, _PCA9685_MODE1)
+        if not mode1 & _PCA9685_MODE1_AI:
+            self._bus.write_byte_data(
+                i2c_address,
+                _PCA9685_MODE1,
+                (mode1 & ~_PCA9685_MODE1_RESTART) | _PCA9685_MODE1_AI)
+
+    def _fast_setPWM(self, pwm_duty_cycle: int):
+        """LEDn_ON/OFFの4レジスタを1回のI2C転送で書き込む
 
         Args:
-            pwm_duty_cycle (int): duty_cycle
+            pwm_duty_cycle (int): 0~4095のduty比、範囲外は丸める
         """
-        self.pi.write(self.in1, 1)
-        self.pi.write(self.in2, 0)
-        self.pwm.setPWM(abs(pwm_duty_cycle))
+        # LEDn_OFF_Hのbit4はfull OFFなので、上位は下位4bitだけを書く
+        pwm_duty_cycle = max(0, min(4095, int(pwm_duty_cycle)))
+        self._i2c_rdwr(i2c_msg.write(
+            self._i2c_address,
+            [self._led_reg, 0, 0,
+             pwm_duty_cycle & 0xFF, (pwm_duty_cycle >> 8) & 0x0F]))
+
+    def _set_duty(self, pwm_duty_cycle: int):
+        """duty比を設定する、前回との差が_DUTY_DEADBAND以内なら書き込まない
+
+        0は停止に使うので差に関係なく書き込む
+
+        Args:
+            pwm_duty_cycle (int): 0~4095のduty比
+        """
+        last_duty = self._last_duty
+        if pwm_duty_cycle == last_duty:
+            return
+        if pwm_duty_cycle and last_duty is not None and \
+                abs(pwm_duty_cycle - last_duty) <= _DUTY_DEADBAND:
+            return
+
+        self._write_duty(pwm_duty_cycle)
+        self._last_duty = pwm_duty_cycle
 
-    def _back(self, pwm_duty_cycle: int):
-        """逆転用の関数
+    def _set_pins(self, levels: int):
+        """IN1/IN2をbank操作でまとめて設定する、変化が無ければ何もしない
 
         Args:
-            pwm_duty_cycle (int): duty_cycle
+            levels (int): HIGHにするピンのビットマスク
         """
-        self.pi.write(self.in1, 0)
-        self.pi.write(self.in2, 1)
-        self.pwm.setPWM(abs(pwm_duty_cycle))
+        changed = levels ^ self._pin_state
+        if not changed:
+            return
+
+        on = changed & levels
+        off = changed & self._pin_state
+        self._pin_state = levels
+
+        # pigpiodはコマンドを届いた順に実行するので、bank操作なら後の書き込みに追い越されない
+        if on:
+            self._set_bank_1(on)
+        if off:
+            self._clear_bank_1(off)
+
+    def _set_direction(self, pin_mask: int, pwm_duty_cycle: int):
+        """回転方向のピンとduty比を設定する
+
+        Args:
+            pin_mask (int): HIGHにするピンのビットマスク、正転は_mask_in1、逆転は_mask_in2
+            pwm_duty_cycle (int): duty比の絶対値
+        """
+        self._set_pins(pin_mask)
+        self._set_duty(pwm_duty_cycle)
+
+    @property
+    def angle(self) -> float:
+        """現在の角度、カウントから都度計算するので誤差が積もらない
+        """
+        return self.count * self.one_count
 
     def get_current_angle(self) -> float:
         """現在の角度を返す
@@ -203,28 +1003,46 @@ class VNH5019:
         Returns:
             float: 今の角度
         """
-        return self.angle
+        return self.count * self.one_count
 
     def get_rotation_speed(self) -> float:
         """現在の回転速度を返す
 
+        直近speed_window回分のエッジから平均の速度を求める
+        エッジ間の時間が短すぎるときは前回の値を返す
+
         Returns:
             float: 今の回転速度
         """
-        return self.rotation_speed
+        idx = self._edge_idx
+        old = (idx - self._speed_window) & _EDGE_BUF_MASK
+
+        elapsed_ns = self._edge_ns[idx] - self._edge_ns[old]
+        if elapsed_ns < _MIN_SPEED_DT_NS:
+            return self._rotation_speed
+
+        elapsed_count = self._edge_count[idx] - self._edge_count[old]
+        self._rotation_speed = elapsed_count * self._speed_scale / elapsed_ns
+        return self._rotation_speed
 
     def reset_angle(self):
         """角度を初期化する
         """
-        self.angle = 0
         self.count = 0
+        self._rotation_speed = 0.0
+
+        # 古いカウントで速度が跳ねないよう履歴も初期化する
+        now_ns = monotonic_ns()
+        for i in range(_EDGE_BUF_LEN):
+            self._edge_ns[i] = now_ns
+            self._edge_count[i] = 0
 
     def reset_PIDparams(self):
         """PIDパラメータを初期化する
         """
-        self.error = 0
-        self.diff = 0
-        self.prev_time = datetime.now()
+        self.error = 0.0
+        self.diff = 0.0
+        self.prev_time_ns = monotonic_ns()
 
     def motor_speed(self, speed: float):
         """モーターを特定速度で回転させる関数
@@ -233,14 +1051,8 @@ class VNH5019:
             speed (float): 回転速度(degree/s)
         """
 
-        duty_cycle = 5 * speed
-
-        duty_cycle = int(duty_cycle)
-
-        if duty_cycle > 4095:
-            duty_cycle = 4095
-        elif duty_cycle < -4095:
-            duty_cycle = -4095
+        # JITの型特殊化を事前コンパイル分と揃える
+        duty_cycle = _compute_duty(float(speed))
 
         self.drive(pwm_duty_cycle=duty_cycle)
 
@@ -250,50 +1062,40 @@ class VNH5019:
         KP: float = 0.5,
         KI: float = 0.0,
         KD: float = 0.0,
+        now_ns: int = None,
     ):
         """モーターを特定速度で回転させる関数、速度フィードバック付き
 
         Args:
             speed (float): 回転速度(degree/s)
             KP (float, optional): 比例ゲイン. Defaults to 1.0.
+            now_ns (int, optional): 制御ループで取得済みの時刻(ns). Defaults to None.
         """
 
         current_speed = self.get_rotation_speed()
-        current_time = datetime.now()
-
-        diff = speed - current_speed
-        if abs(diff) > 6000:
-            pass
-        else:
-            self.diff = diff
+        # 制御ループで取得済みの時刻があれば使い回す
+        current_time = monotonic_ns() if now_ns is None else now_ns
 
-        self.error += self.diff
+        # 同じ時刻で呼ばれてもKDの項が発散しないようにする
+        delta_time = max((current_time - self.prev_time_ns) * 1e-9, _MIN_DT)
 
-        delta_time = (current_time - self.prev_time) / timedelta(seconds=1)
+        speed, self.diff, self.error = _pid_step(
+            speed, current_speed, self.error, delta_time, KP, KI, KD)
 
-        raw_gain = speed + KP * self.diff + KI * self.error * \
-            delta_time + KD * self.error / delta_time
-        speed = int(raw_gain)
+        # 取得済みの時刻で間引き、_PRINT_INTERVAL_NSに1回だけ書式化して出力する
+        if self._debug and current_time >= self._next_print_ns and self.diff:
+            self._next_print_ns = current_time + _PRINT_INTERVAL_NS
+            self.logger.debug(
+                "input_speed=%d current_speed=%.0f angle=%s delta_time=%s",
+                speed, current_speed, self.angle, delta_time)
 
-        """
-        if self.print_counter % 50 == 0:
-            if abs(self.diff) > 0:
-                # print(f"gain={(100 / speed):.5f}")
-                # print(f"diff={self.diff}")
-                print(f"input_speed={speed}")
-                # print(f"raw_gain={raw_gain}")
-                print(f"current_speed={current_speed:.0f}")
-                # print(f"error={self.error}")
-                # print(f"KI={KI}")
-                print(f"angle={self.get_current_angle()}")
-                print(f"delta_time={delta_time}")
-        """
+        self.prev_time_ns = current_time
 
-        self.print_counter += 1
-        self.prev_time = current_time
-
-        self.motor_speed(speed=speed)
+        # motor_speedを経由せずに直接duty比を計算して駆動する
+        # _pid_stepはintを返すので、JITの型特殊化を事前コンパイル分と揃える
+        self.drive(_compute_duty(float(speed)))
 
+    @_on_control_thread
     def drive_motor_speed(self, speed: float, drive_time: float):
         """特定速度で特定時間回転させる関数
 
@@ -301,32 +1103,15 @@ class VNH5019:
             speed (float): 回転速度
             drive_time (float): 回転時間
         """
-        drive_time = drive_time * 1000 * 1000
-
-        start_time = datetime.now()
-
-        self.print_counter = 0
-
-        while True:
-            driven_time = (datetime.now() - start_time) / \
-                timedelta(microseconds=1)
-
-            """
-            if self.print_counter % 50 == 0:
-                current_speed = self.get_rotation_speed()
-
-                # print(f"duty_cycle={duty_cycle}")
-                print(f"speed={current_speed:.0f}")
-            """
-
-            self.print_counter += 1
+        end_ns = monotonic_ns() + int(drive_time * 1e9)
 
-            self.motor_speed(speed=speed)
-
-            if driven_time > drive_time:
-                self.brake()
-                break
+        # フィードバックが無くduty比は一定なので一度設定して待つ
+        self.motor_speed(speed=speed)
+        if _sleep_until(end_ns, self._stop):
+            return
+        self._brake()
 
+    @_on_control_thread
     def drive_motor_speed_EX(
         self,
         speed: float,
@@ -345,65 +1130,94 @@ class VNH5019:
         """
         self.reset_PIDparams()
 
-        drive_time = drive_time * 1000 * 1000
+        # JITの型特殊化を事前コンパイル分と揃える
+        speed, KP, KI, KD = float(speed), float(KP), float(KI), float(KD)
+
+        end_ns = monotonic_ns() + int(drive_time * 1e9)
+
+        # 拡張モジュールがあれば制御ループをCで回す、デバッグ出力はPython側のみ
+        if _vnh5019_core is not None and not self._debug:
+            self.diff, self.error, self.prev_time_ns = \
+                _vnh5019_core.run_speed_loop(
+                    self.get_rotation_speed,
+                    self.drive,
+                    speed,
+                    end_ns,
+                    KP,
+                    KI,
+                    KD,
+                    self.period_ns,
+                    self.prev_time_ns,
+                    self.diff,
+                    self.error,
+                    self._stop)
+            if not self._stop.is_set():
+                self._brake()
+            return
 
-        start_time = datetime.now()
+        # ループ内で使うメソッドはローカル変数に束縛しておく
+        motor_speed_EX = self.motor_speed_EX
 
-        self.print_counter = 0
+        period_ns = self.period_ns
 
-        while True:
-            driven_time = (datetime.now() - start_time) / \
-                timedelta(microseconds=1)
+        for now_ns, expirations in _ticks(period_ns, self._stop):
+            # 周期に遅れたときは経過時間を1周期とみなし、積分項が跳ねないようにする
+            if expirations > 1:
+                self.prev_time_ns = now_ns - period_ns
 
-            self.motor_speed_EX(speed=speed, KP=KP, KI=KI, KD=KD)
+            motor_speed_EX(speed, KP, KI, KD, now_ns)
 
-            if driven_time > drive_time:
-                self.brake()
+            if now_ns > end_ns:
+                self._brake()
                 break
 
-    def rotate_motor(self, pwm_duty_cycle: int, rotation_angle: float):
+    @_on_control_thread
+    def rotate_motor(
+            self,
+            pwm_duty_cycle: int,
+            rotation_angle: float,
+            timeout: float = None,
+            dwell_time: float = 0.01) -> bool:
         """モーターを指定角度まで指定のduty比で回転させる関数
 
+        駆動の切り替えはエンコーダのコールバックで行うので、待機中はCPUを使わない
+        目標付近に着いたらduty比を落とし、dwell_timeの間位置を合わせてからブレーキする
+
         Args:
-            pwm_duty_cycle (int): duty比
+            pwm_duty_cycle (int): duty比、符号は無視する
             rotation_angle (float): 目標角度
-        """
-
-        while True:
-            current_angle = self.get_current_angle()
-
-            diff = rotation_angle - current_angle
+            timeout (float, optional): 目標に着くまで待つ秒数. Defaults to None.
+            dwell_time (float, optional): 位置を合わせる秒数. Defaults to 0.01.
 
-            if diff > 0:
-                self._forward(pwm_duty_cycle)
-            else:
-                self._back(pwm_duty_cycle)
-
-            self.logger.debug(current_angle)
-
-            if abs(diff) < self.one_count:
-                self.free()
-                break
+        Returns:
+            bool: timeoutまでに目標に着いたかどうか
+        """
+        self._angle_event.clear()
+        # 向きは目標との差で決めるので、duty比は絶対値だけを使う
+        self._seek_duty = abs(pwm_duty_cycle)
+        self._seek_dir = 0
+        self._target_count = round(rotation_angle / self.one_count)
 
-        cnt = 0
-        while True:
-            current_angle = self.get_current_angle()
+        # 最初の駆動だけここで行う
+        self._seek()
+        reached = self._angle_event.wait(timeout)
 
-            diff = rotation_angle - current_angle
+        if reached:
+            self._stop.wait(dwell_time)
 
-            if diff > 0:
-                self._forward(600)
-            else:
-                self._back(600)
+        with self._seek_lock:
+            self._target_count = None
+            # 停止を指示されたら目標を外すだけにし、出力は停止した側に任せる
+            if self._stop.is_set():
+                return False
+            self._brake()
 
-            self.logger.debug(current_angle)
+        if self._debug:
+            self.logger.debug("%s", self.angle)
 
-            if abs(diff) < self.one_count:
-                cnt += 1
-                if cnt == 10:
-                    self.brake()
-                    break
+        return reached
 
+    @_on_control_thread
     def rotate_motor_EX(
         self,
         rotation_angle: float,
@@ -430,39 +1244,44 @@ class VNH5019:
 
         flag = 1
 
-        while True:
-            current_angle = self.get_current_angle()
+        # JITの型特殊化を事前コンパイル分と揃える
+        KP = float(KP)
+
+        # ループ内で変わらない値はローカル変数に持つ
+        one_count = self.one_count
+        debug = self._debug
+        get_current_angle = self.get_current_angle
+        motor_speed_EX = self.motor_speed_EX
+
+        period_ns = self.period_ns
+
+        for now_ns, expirations in _ticks(period_ns, self._stop):
+            # 周期に遅れたときは経過時間を1周期とみなし、積分項が跳ねないようにする
+            if expirations > 1:
+                self.prev_time_ns = now_ns - period_ns
+
+            current_angle = get_current_angle()
 
             diff = rotation_angle - current_angle
 
-            pow = KP * diff
-            pow = int(pow)
-            if abs(pow) < min_speed:
-                if pow > 0:
-                    pow = min_speed
-                else:
-                    pow = min_speed * -1
-            elif abs(pow) > max_speed:
-                if pow > 0:
-                    pow = max_speed
-                else:
-                    pow = max_speed * -1
-
-            if abs(diff) <= self.one_count:
+            pow = _compute_pow(diff, KP, min_speed, max_speed)
+
+            if abs(diff) <= one_count:
                 flag = 1
                 cnt += 1
 
             if flag == 1:
                 pow = pow / 6
                 # KP = KP / 10
-                KI = KD = 0
+                KI = KD = 0.0
 
             if cnt == 10:
-                self.brake()
+                self._brake()
                 break
 
             # self.drive(pwm_duty_cycle=pow)
-            self.motor_speed_EX(speed=pow, KP=KP, KI=KI, KD=KD)
+            motor_speed_EX(pow, KP, KI, KD, now_ns)
 
-            self.logger.debug(f"current_angle={current_angle}")
-            self.logger.debug(f"pow={pow}")
+            if debug:
+                self.logger.debug("current_angle=%s", current_angle)
+                self.logger.debug("pow=%s", pow)
@@ -4,16 +4,12 @@
 import time
 from logging import DEBUG, ERROR, FATAL, INFO, WARN
 
-import pigpio
-
 from VNH5019_driver import VNH5019 as MOTOR
 
 if __name__ == "__main__":
 
-    count = 0.0
-    one_count = 360 * 4 / (64 * 50)
-
-    pi = pigpio.pi()
+    # 2つのモーターでpigpiodとの接続を共有する
+    pi = MOTOR.shared_pi()
 
     motor0 = MOTOR(
         pi,
@@ -35,10 +31,18 @@ if __name__ == "__main__":
         gear_ratio=50,
         logging_level=WARN)
 
+    # root権限があれば制御ループをリアルタイム優先度で回す
+    # motor0.enable_realtime(cpu=2, prio=80)
+
     time.sleep(3)
 
-    motor0.rotate_motor(pwm_duty_cycle=500, rotation_angle=180)
-    motor1.rotate_motor(pwm_duty_cycle=500, rotation_angle=180)
+    # 制御は各モーターのスレッドで回るので、待たずに投げれば2つ同時に動く
+    done0 = motor0.rotate_motor(
+        pwm_duty_cycle=500, rotation_angle=180, wait=False)
+    done1 = motor1.rotate_motor(
+        pwm_duty_cycle=500, rotation_angle=180, wait=False)
+    done0.result()
+    done1.result()
     #motor0.drive(pwm_duty_cycle=4095)
     #motor1.drive(pwm_duty_cycle=4095)
 
@@ -47,4 +51,6 @@ if __name__ == "__main__":
     print(motor0.get_current_angle())
     print(motor1.get_current_angle())
 
+    MOTOR.free_all(motor0, motor1)
+
     # メモ I制御を導入して平滑化したい、ゲインにスピードの逆数かけるのやめたい
@@ -0,0 +1,124 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""VNH5019の速度フィードバック制御ループをCで回すための拡張モジュール
+
+ビルド方法
+    python build_ext.py build_ext --inplace
+"""
+
+from libc.math cimport copysign, fabs, fmax, fmin
+
+
+cdef extern from "<time.h>" nogil:
+    ctypedef int clockid_t
+    ctypedef long time_t
+
+    cdef struct timespec:
+        time_t tv_sec
+        long tv_nsec
+
+    clockid_t CLOCK_MONOTONIC
+    int TIMER_ABSTIME
+
+    int clock_gettime(clockid_t clk_id, timespec *tp)
+    int clock_nanosleep(
+        clockid_t clock_id, int flags, const timespec *request,
+        timespec *remain)
+
+
+cdef inline long long _now_ns() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return <long long>ts.tv_sec * 1000000000 + ts.tv_nsec
+
+
+cdef inline void _sleep_until(long long deadline_ns) noexcept nogil:
+    cdef timespec ts
+    ts.tv_sec = <time_t>(deadline_ns // 1000000000)
+    ts.tv_nsec = <long>(deadline_ns % 1000000000)
+    clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &ts, NULL)
+
+
+def run_speed_loop(
+        get_speed,
+        drive,
+        double speed,
+        long long end_ns,
+        double KP,
+        double KI,
+        double KD,
+        long long period_ns,
+        long long prev_ns,
+        double diff,
+        double error,
+        stop):
+    """drive_motor_speed_EXと同じPID制御をend_nsまで一定周期で回す
+
+    Pythonに戻るのは回転速度の取得とduty比が変わったときの駆動だけ
+
+    Args:
+        get_speed (callable): 現在の回転速度を返す関数
+        drive (callable): duty比を受け取ってモーターを駆動する関数
+        speed (float): 目標の回転速度(degree/s)
+        end_ns (int): 終了時刻(monotonic ns)
+        KP (float): 比例ゲイン
+        KI (float): 積分ゲイン
+        KD (float): 微分ゲイン
+        period_ns (int): 制御周期(ns)
+        prev_ns (int): 前回の制御時刻(monotonic ns)
+        diff (float): 前回の偏差
+        error (float): 偏差の積算値
+        stop (threading.Event): セットされたら途中で終了する
+
+    Returns:
+        tuple: 最後の(偏差, 偏差の積算値, 制御時刻)
+    """
+    cdef long long next_ns = _now_ns()
+    cdef long long now_ns, behind_ns
+    cdef bint overrun = False
+    cdef double delta_time, raw_gain, raw
+    cdef int duty
+    cdef int last_duty = 0
+    cdef bint first = True
+
+    while True:
+        with nogil:
+            _sleep_until(next_ns)
+            now_ns = _now_ns()
+
+        if stop.is_set():
+            break
+
+        # 周期に遅れたときは経過時間を1周期とみなし、積分項が跳ねないようにする
+        if overrun or now_ns - next_ns >= period_ns:
+            prev_ns = now_ns - period_ns
+            overrun = False
+
+        diff = speed - <double>get_speed()
+        error += diff
+
+        delta_time = fmax((now_ns - prev_ns) * 1e-9, 1e-6)
+
+        raw_gain = speed + KP * diff + KI * error * delta_time + \
+            KD * error / delta_time
+        # intへの変換で溢れないよう、duty比が飽和する範囲で丸めておく
+        raw_gain = fmin(1e6, fmax(-1e6, raw_gain))
+        raw = 5.0 * <int>raw_gain
+        duty = <int>copysign(fmin(4095.0, fabs(raw)), raw)
+
+        if first or duty != last_duty:
+            drive(duty)
+            last_duty = duty
+            first = False
+
+        prev_ns = now_ns
+
+        if now_ns > end_ns:
+            break
+
+        next_ns += period_ns
+        behind_ns = _now_ns() - next_ns
+        if behind_ns > period_ns:
+            next_ns += behind_ns // period_ns * period_ns
+            overrun = True
+
+    return diff, error, prev_ns
@@ -0,0 +1,29 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""examples内の拡張モジュールをビルドする
+
+python build_ext.py build_ext --inplace
+"""
+
+import setuptools
+from Cython.Build import cythonize
+
+setuptools.setup(
+    name="VNH5019_examples_ext",
+    ext_modules=cythonize(
+        [
+            setuptools.Extension(
+                "_vnh5019_core",
+                ["_vnh5019_core.pyx"],
+                extra_compile_args=["-O3"],
+            ),
+        ],
+    ) + [
+        setuptools.Extension(
+            "_qdec",
+            ["_qdec.c"],
+            extra_compile_args=["-O3"],
+        ),
+    ],
+)
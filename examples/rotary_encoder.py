@@ -1,22 +1,77 @@
 #!/usr/bin/env python3
 
 import atexit
-from datetime import datetime, timedelta
+import os
+import struct
+import threading
+from array import array
+from time import monotonic_ns
 
 import pigpio
 
 
+# Direction for each (previous A, previous B, A, B) transition, indexed
+# by (prevA << 3) | (prevB << 2) | (A << 1) | B.  Valid quadrature steps
+# give +1/-1, no change and invalid double steps give 0.
+_TRANSITIONS = array('b', [
+    0, 1, -1, 0,
+    -1, 0, 0, 1,
+    1, 0, 0, -1,
+    0, -1, 1, 0,
+])
+
+# pigpio notification reports: seqno (H), flags (H), tick (I), level (I).
+_REPORT = struct.Struct("HHII")
+
+# Reports read from the notification pipe in one os.read.
+_NOTIFY_BATCH = 256
+
+
+def _decode_reports(data, shiftA, shiftB, prev):
+    """
+    Decode a run of notification reports.  Returns the net number
+    of steps and the last (A << 1) | B state.
+    """
+
+    way = 0
+    for _seqno, flags, _tick, level in _REPORT.iter_unpack(data):
+        if flags:  # watchdog, keep-alive or event report
+            continue
+        state = (((level >> shiftA) & 1) << 1) | ((level >> shiftB) & 1)
+        way += _TRANSITIONS[(prev << 2) | state]
+        prev = state
+    return way, prev
+
+
+# Same decoder compiled in C, see build_ext.py.
+try:
+    from _qdec import decode as _decode_reports
+except ImportError:
+    pass
+
+
 class RotaryEncoder:
     """Class to decode mechanical rotary encoder pulses."""
 
-    def __init__(self, pi, gpioA, gpioB, callback):
+    def __init__(self, pi, gpioA, gpioB, callback, glitch_us=0, notify=True):
         """
         Instantiate the class with the pi and gpios connected to
         rotary encoder contacts A and B.  The common contact
         should be connected to ground.  The callback is
         called when the rotary encoder is turned.  It takes
         one parameter which is +1 for clockwise and -1 for
-        counterclockwise.
+        counterclockwise.  Every edge of both channels is
+        decoded, so there are four steps per quadrature cycle.
+
+        If glitch_us is non-zero, pigpiod drops any level change
+        that is not stable for glitch_us microseconds, so contact
+        bounce never reaches the Python callback.
+
+        If notify is True, level changes are read in batches from
+        pigpiod's notification pipe by a single thread and the
+        callback gets the net number of steps per batch.  This only
+        works when pigpiod runs on the local machine; otherwise the
+        per-edge pigpio callbacks are used.
 
         EXAMPLE
 
@@ -52,19 +107,88 @@ class RotaryEncoder:
         self.gpioB = gpioB
         self.callback = callback
 
-        self.levA = 0
-        self.levB = 0
-
-        self.lastGpio = None
-
         self.pi.set_mode(gpioA, pigpio.INPUT)
         self.pi.set_mode(gpioB, pigpio.INPUT)
 
         self.pi.set_pull_up_down(gpioA, pigpio.PUD_UP)
         self.pi.set_pull_up_down(gpioB, pigpio.PUD_UP)
 
-        self.cbA = self.pi.callback(gpioA, pigpio.EITHER_EDGE, self._pulse)
-        self.cbB = self.pi.callback(gpioB, pigpio.EITHER_EDGE, self._pulse)
+        self.levA = self.pi.read(gpioA)
+        self.levB = self.pi.read(gpioB)
+        self._prev = (self.levA << 1) | self.levB
+
+        if glitch_us:
+            self.pi.set_glitch_filter(gpioA, glitch_us)
+            self.pi.set_glitch_filter(gpioB, glitch_us)
+
+        self._notify_handle = None
+        self._notify_fd = None
+        self.cbA = None
+        self.cbB = None
+
+        if notify:
+            self._open_notify()
+
+        if self._notify_fd is None:
+            self.cbA = self.pi.callback(gpioA, pigpio.EITHER_EDGE, self._pulse)
+            self.cbB = self.pi.callback(gpioB, pigpio.EITHER_EDGE, self._pulse)
+        else:
+            self._reader = threading.Thread(target=self._read_notify, daemon=True)
+            self._reader.start()
+
+    def _open_notify(self):
+        """
+        Open a pigpiod notification pipe for both gpios.  Leaves
+        _notify_fd as None if the pipe is not available.
+        """
+
+        try:
+            handle = self.pi.notify_open()
+        except pigpio.error:
+            return
+
+        try:
+            fd = os.open("/dev/pigpio{}".format(handle), os.O_RDONLY)
+        except OSError:
+            self.pi.notify_close(handle)
+            return
+
+        self._notify_handle = handle
+        self._notify_fd = fd
+        self.pi.notify_begin(handle, (1 << self.gpioA) | (1 << self.gpioB))
+
+    def _read_notify(self):
+        """
+        Decode the notification reports a batch at a time until the
+        pipe is closed.
+        """
+
+        fd = self._notify_fd
+        shiftA = self.gpioA
+        shiftB = self.gpioB
+        decode = _decode_reports
+        size = _REPORT.size
+        pending = b""
+
+        while True:
+            try:
+                data = os.read(fd, size * _NOTIFY_BATCH)
+            except OSError:
+                break
+            if not data:
+                break
+
+            # A report may be split between reads, keep the tail.
+            data = pending + data
+            end = len(data) - len(data) % size
+            pending = data[end:]
+
+            way, self._prev = decode(data[:end], shiftA, shiftB, self._prev)
+
+            if way:
+                self.callback(way)
+
+        os.close(fd)
 
 
     def _pulse(self, gpio, level, tick):
@@ -84,29 +208,34 @@ class RotaryEncoder:
            ----+         +---------+         +---------+  1
         """
 
+        if level > 1:  # watchdog timeout, no level change
+            return
+
         if gpio == self.gpioA:
             self.levA = level
         else:
             self.levB = level
 
-        if gpio != self.lastGpio:  # debounce
-            self.lastGpio = gpio
+        # Bounces decode to 0 or cancel out, so no separate debounce.
+        state = (self.levA << 1) | self.levB
+        way = _TRANSITIONS[(self._prev << 2) | state]
+        self._prev = state
 
-            if gpio == self.gpioA and level == 1:
-                if self.levB == 1:
-                    self.callback(1)
-            elif gpio == self.gpioB and level == 1:
-                if self.levA == 1:
-                    self.callback(-1)
+        if way:
+            self.callback(way)
 
     def cancel(self):
         """
         Cancel the rotary encoder decoder.
         """
 
-        self.cbA.cancel()
-        self.cbB.cancel()
-        self.pi.stop()
+        if self._notify_handle is not None:
+            # pigpiod closes the pipe, which ends the reader thread.
+            self.pi.notify_close(self._notify_handle)
+            self._notify_handle = None
+        else:
+            self.cbA.cancel()
+            self.cbB.cancel()
 
 
 if __name__ == "__main__":
@@ -114,32 +243,32 @@ if __name__ == "__main__":
     import time
 
     count = 0.0
-    prev_current_time = datetime.now()
+    prev_current_time_ns = monotonic_ns()
 
-    # 一カウントあたりの回転角 = 360 / 一回転あたりのパルス / ギア比（１ﾃｲﾊﾞｲ）
-    # 立ち上がり立ち下がりが4回
+    # 一カウントあたりの回転角 = 360 / 一回転あたりのカウント / ギア比
+    # A相B相の立ち上がり立ち下がりを全て数える(4逓倍)
     # https://jp.cuidevices.com/blog/what-is-encoder-ppr-cpr-and-lpr#cpr
-    one_count = 360 * 4 / (64 * 50)
+    one_count = 360 / (64 * 50)
 
     def callback(way):
 
         global count
-        global prev_current_time
+        global prev_current_time_ns
 
-        current_time = datetime.now()
+        current_time_ns = monotonic_ns()
 
         count += way
         print(way)
 
+        # wayはまとめて届いた分の正味のカウント数
         pos = count * one_count
-        eplased_time = (current_time - prev_current_time) / \
-            timedelta(seconds=1)
-        rotation_speed = one_count / eplased_time
+        eplased_time = (current_time_ns - prev_current_time_ns) * 1e-9
+        rotation_speed = way * one_count / eplased_time
 
         # print(f"pos={pos:.0f}")
         # print(f"rotation_speed={rotation_speed:.0f}")
 
-        prev_current_time = current_time
+        prev_current_time_ns = current_time_ns
 
     pi = pigpio.pi()
 